@@ -3,7 +3,6 @@ from typing import Dict
 from typing import List
 from typing import Optional
 
-import attr
 from colorama import Fore
 
 from semgrep.rule_lang import Position
@@ -120,7 +119,7 @@ class ErrorWithSpan(SemgrepError):
             short_msg=self.short_msg,
             long_msg=self.long_msg,
             level=self.level,
-            spans=[attr.asdict(s) for s in self.spans],
+            spans=[s.to_json() for s in self.spans],
         )
         # otherwise, we end up with `help: null` in JSON
         if self.help:
@@ -184,7 +183,7 @@ class ErrorWithSpan(SemgrepError):
             snippet = [location_hint]
 
             # all the lines of code in the file this comes from
-            source: List[str] = SourceTracker.source(span.source_hash)
+            source: List[str] = SourceTracker.source_lines(span.source_hash)
 
             # First, print the span from `context_start` to `start`
             # Next, sprint the focus of the span from `start` to `end`
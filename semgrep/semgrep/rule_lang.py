@@ -1,5 +1,6 @@
+import functools
 import hashlib
-from io import StringIO
+import re
 from typing import Any
 from typing import Dict
 from typing import Generic
@@ -8,12 +9,14 @@ from typing import KeysView
 from typing import List
 from typing import NewType
 from typing import Optional
+from typing import Set
+from typing import Tuple
 from typing import TypeVar
 from typing import Union
 
 import attr
 from ruamel.yaml import Node
-from ruamel.yaml import RoundTripConstructor
+from ruamel.yaml import SafeConstructor
 from ruamel.yaml import YAML
 
 from semgrep.constants import PLEASE_FILE_ISSUE_TEXT
@@ -21,6 +24,11 @@ from semgrep.constants import PLEASE_FILE_ISSUE_TEXT
 # Do not construct directly, use `SpanBuilder().add_source`
 SourceFileHash = NewType("SourceFileHash", str)
 
+HASH_CHUNK_SIZE = 64 * 1024
+
+# Line breaks recognized by `str.splitlines` other than "\n" (and "\r\n")
+OTHER_LINE_BREAKS = re.compile("\r(?!\n)|[\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]")
+
 
 class SourceTracker:
     """
@@ -28,27 +36,67 @@ class SourceTracker:
     building error messages from Spans
     """
 
-    # sources are a class variable to share state
-    sources: Dict[SourceFileHash, List[str]] = {}
+    # sources are a class variable to share state. `EmptySpan` points at the empty hash,
+    # so it is registered up front with no contents
+    sources: Dict[SourceFileHash, str] = {SourceFileHash(""): ""}
+    # lines of each source, split on first use since most spans are never rendered
+    _source_lines: Dict[SourceFileHash, List[str]] = {}
+    # number of lines in each source, without having to split it
+    _line_counts: Dict[SourceFileHash, int] = {SourceFileHash(""): 0}
+    # contents -> hash, so re-registering the same file doesn't hash it again
+    _hash_cache: Dict[str, SourceFileHash] = {}
 
     @classmethod
     def add_source(cls, source: str) -> SourceFileHash:
-        file_hash = cls._src_to_hash(source)
-        cls.sources[file_hash] = source.splitlines()
+        file_hash = cls._hash_cache.get(source)
+        if file_hash is None:
+            file_hash = cls._src_to_hash(source)
+            cls._hash_cache[source] = file_hash
+        if file_hash not in cls.sources:
+            cls.sources[file_hash] = source
+            cls._line_counts[file_hash] = cls._count_lines(source)
         return file_hash
 
     @classmethod
-    def source(cls, source_hash: SourceFileHash) -> List[str]:
+    def source(cls, source_hash: SourceFileHash) -> str:
         return cls.sources[source_hash]
 
+    @classmethod
+    def source_lines(cls, source_hash: SourceFileHash) -> List[str]:
+        lines = cls._source_lines.get(source_hash)
+        if lines is None:
+            lines = cls.sources[source_hash].splitlines()
+            cls._source_lines[source_hash] = lines
+        return lines
+
+    @classmethod
+    def line_count(cls, source_hash: SourceFileHash) -> int:
+        return cls._line_counts[source_hash]
+
+    @staticmethod
+    def _count_lines(source: str) -> int:
+        # Same as len(source.splitlines()), which is what error rendering uses. Counting "\n"
+        # is enough (and doesn't build a list) unless the source has other line breaks
+        if not source:
+            return 0
+        if OTHER_LINE_BREAKS.search(source):
+            return len(source.splitlines())
+        return source.count("\n") + (0 if source.endswith("\n") else 1)
+
     @staticmethod
     def _src_to_hash(contents: Union[str, bytes]) -> SourceFileHash:
+        # the hash is only a key into `sources`, so it doesn't need to be SHA-256
+        file_hash = hashlib.blake2b(digest_size=16)
         if isinstance(contents, str):
-            contents = contents.encode("utf-8")
-        return SourceFileHash(hashlib.sha256(contents).hexdigest())
+            # encode piecewise so hashing a large file doesn't make a full-size bytes copy
+            for i in range(0, len(contents), HASH_CHUNK_SIZE):
+                file_hash.update(contents[i : i + HASH_CHUNK_SIZE].encode("utf-8"))
+        else:
+            file_hash.update(contents)
+        return SourceFileHash(file_hash.hexdigest())
 
 
-@attr.s(auto_attribs=True, frozen=True, repr=False)
+@attr.s(auto_attribs=True, frozen=True, slots=True, repr=False)
 class Position:
     """
     Position within a file.
@@ -62,24 +110,35 @@ class Position:
     col: int
 
     def next_line(self) -> "Position":
-        return attr.evolve(self, line=self.line + 1)
+        return Position(line=self.line + 1, col=self.col)
 
     def previous_line(self) -> "Position":
-        return attr.evolve(self, line=self.line - 1)
+        return Position(line=self.line - 1, col=self.col)
 
     def __repr__(self) -> str:
         return f"<{self.__class__.__name__} line={self.line} col={self.col}>"
 
 
-@attr.s(auto_attribs=True, frozen=True, repr=False)
+@functools.lru_cache(maxsize=4096)
+def _position(line: int, col: int) -> Position:
+    # Positions are immutable, so the same few (line, col) pairs can be shared
+    return Position(line=line, col=col)
+
+
+@attr.s(auto_attribs=True, frozen=True, slots=True, repr=False)
 class Span:
     """
     Spans are immutable objects, representing segments of code. They have a central focus area, and
     optionally can contain surrounding context.
+
+    The endpoints are stored as plain ints so that building a span for every yaml node doesn't
+    allocate two `Position`s each time; `start` and `end` build them when they're actually read.
     """
 
-    start: Position
-    end: Position
+    start_line: int
+    start_col: int
+    end_line: int
+    end_col: int
     source_hash: SourceFileHash
     file: Optional[str]
     context_start: Optional[Position] = None
@@ -89,9 +148,22 @@ class Span:
     def from_node(
         cls, node: Node, source_hash: SourceFileHash, filename: Optional[str]
     ) -> "Span":
-        start = Position(line=node.start_mark.line + 1, col=node.start_mark.column + 1)
-        end = Position(line=node.end_mark.line + 1, col=node.end_mark.column + 1)
-        return Span(start=start, end=end, file=filename, source_hash=source_hash)
+        return Span(
+            start_line=node.start_mark.line + 1,
+            start_col=node.start_mark.column + 1,
+            end_line=node.end_mark.line + 1,
+            end_col=node.end_mark.column + 1,
+            file=filename,
+            source_hash=source_hash,
+        )
+
+    @property
+    def start(self) -> Position:
+        return _position(self.start_line, self.start_col)
+
+    @property
+    def end(self) -> Position:
+        return _position(self.end_line, self.end_col)
 
     def truncate(self, lines: int) -> "Span":
         """
@@ -99,10 +171,15 @@ class Span:
         - start_context is not considered.
         - end_context is removed
         """
-        if self.end.line - self.start.line > lines:
-            return attr.evolve(
-                self,
-                end=Position(line=self.start.line + lines, col=0),
+        if self.end_line - self.start_line > lines:
+            return Span(
+                start_line=self.start_line,
+                start_col=self.start_col,
+                end_line=self.start_line + lines,
+                end_col=0,
+                source_hash=self.source_hash,
+                file=self.file,
+                context_start=self.context_start,
                 context_end=None,
             )
         return self
@@ -115,9 +192,27 @@ class Span:
         but unlike to core span area, they won't be highlighted in error messages.
         """
         if context_only:
-            return attr.evolve(self, context_end=span.context_end or span.end)
+            return Span(
+                start_line=self.start_line,
+                start_col=self.start_col,
+                end_line=self.end_line,
+                end_col=self.end_col,
+                source_hash=self.source_hash,
+                file=self.file,
+                context_start=self.context_start,
+                context_end=span.context_end or span.end,
+            )
         else:
-            return attr.evolve(self, end=span.end, context_end=span.context_end)
+            return Span(
+                start_line=self.start_line,
+                start_col=self.start_col,
+                end_line=span.end_line,
+                end_col=span.end_col,
+                source_hash=self.source_hash,
+                file=self.file,
+                context_start=self.context_start,
+                context_end=span.context_end,
+            )
 
     def with_context(
         self, before: Optional[int] = None, after: Optional[int] = None
@@ -125,25 +220,44 @@ class Span:
         """
         Expand
         """
-        new = self
+        context_start = self.context_start
         if before is not None:
-            new = attr.evolve(
-                new,
-                context_start=Position(col=0, line=max(0, self.start.line - before)),
-            )
+            start_line = self.start_line - before if self.start_line > before else 0
+            context_start = _position(start_line, 0)
 
+        context_end = self.context_end
         if after is not None:
-            new = attr.evolve(
-                new,
-                context_end=Position(
-                    col=0,
-                    line=min(
-                        len(SourceTracker.source(self.source_hash)),
-                        self.end.line + after,
-                    ),
-                ),
+            end_line = self.end_line + after
+            total_lines = SourceTracker.line_count(self.source_hash)
+            context_end = _position(
+                end_line if end_line < total_lines else total_lines, 0
             )
-        return new
+        return Span(
+            start_line=self.start_line,
+            start_col=self.start_col,
+            end_line=self.end_line,
+            end_col=self.end_col,
+            source_hash=self.source_hash,
+            file=self.file,
+            context_start=context_start,
+            context_end=context_end,
+        )
+
+    def to_json(self) -> Dict[str, Any]:
+        """
+        Serialize for `--json` output. `start` and `end` are nested `{line, col}` objects
+        there, so they're built from the positions rather than the int fields
+        """
+        return {
+            "start": attr.asdict(self.start),
+            "end": attr.asdict(self.end),
+            "source_hash": self.source_hash,
+            "file": self.file,
+            "context_start": attr.asdict(self.context_start)
+            if self.context_start
+            else None,
+            "context_end": attr.asdict(self.context_end) if self.context_end else None,
+        }
 
     def __repr__(self) -> str:
         return f"<{self.__class__.__name__} start={self.start} end={self.end}>"
@@ -155,8 +269,41 @@ LocatedYamlValue = Union[str, int, List["YamlTree"], "YamlMap"]
 
 T = TypeVar("T", bound=LocatedYamlValue)
 
+# Kinds of values `YamlTree.unroll` and `YamlTree.wrap` dispatch on. All truthy, so a
+# lookup miss in `_value_kinds` can fall back with `or`
+_LEAF = 1
+_LIST = 2
+_DICT = 3
+_YAML_MAP = 4
+_YAML_TREE = 5
+_OTHER = 6
+
+# Exact type -> kind, filled in by `_value_kind` the first time each type is seen. Walking
+# a tree then costs one dict lookup per node instead of a chain of isinstance checks, and
+# ruamel's str/list subclasses get the same fast path as the builtins
+_value_kinds: Dict[type, int] = {}
+
+
+def _value_kind(value_type: type) -> int:
+    if issubclass(value_type, list):
+        kind = _LIST
+    elif issubclass(value_type, dict):
+        kind = _DICT
+    elif issubclass(value_type, YamlMap):
+        kind = _YAML_MAP
+    elif issubclass(value_type, YamlTree):
+        kind = _YAML_TREE
+    elif issubclass(value_type, str) or issubclass(value_type, int):
+        kind = _LEAF
+    else:
+        kind = _OTHER
+    _value_kinds[value_type] = kind
+    return kind
+
 
 class YamlTree(Generic[T]):
+    __slots__ = ("value", "span")
+
     def __init__(self, value: T, span: Span):
         self.value = value
         self.span = span
@@ -178,17 +325,54 @@ class YamlTree(Generic[T]):
     def unroll(self) -> YamlValue:
         """
         Recursively expand the `self.value`, converting back to a normal datastructure
+
+        This walks the tree with an explicit stack rather than recursing, so deeply nested
+        rules don't pay for (or run out of) Python frames. Each container is created up front
+        and its slots are filled in as the stack reaches them.
         """
-        if isinstance(self.value, list):
-            return [x.unroll() for x in self.value]
-        elif isinstance(self.value, YamlMap):
-            return {str(k.unroll()): v.unroll() for k, v in self.value.items()}
-        elif isinstance(self.value, YamlTree):
-            return self.value.unroll()
-        elif isinstance(self.value, str) or isinstance(self.value, int):
-            return self.value
-        else:
-            raise ValueError("Invalid YAML tree structure")
+        return self._unroll(set())
+
+    def _unroll(self, path: Set[int]) -> YamlValue:
+        """
+        :param path: ids of the containers being expanded between the root and this node. Aliases
+        can make a tree contain itself (eg. `a: &a [*a]`), which would otherwise never finish
+        """
+        result: List[Any] = [None]
+        stack: List[Tuple[Any, Any, Any]] = [(self, result, 0)]
+        while stack:
+            node, parent, slot = stack.pop()
+            if node is _LEAVE:
+                # every child of the container `parent` has been expanded
+                path.discard(parent)
+                continue
+            value = node.value
+            value_type = type(value)
+            kind = _value_kinds.get(value_type) or _value_kind(value_type)
+            if kind == _LEAF:
+                parent[slot] = value
+            elif kind == _LIST:
+                _enter_container(path, stack, id(value))
+                out: List[Any] = [None] * len(value)
+                parent[slot] = out
+                for i in range(len(value) - 1, -1, -1):
+                    stack.append((value[i], out, i))
+            elif kind == _YAML_MAP:
+                # each alias of a mapping gets its own YamlMap, but they share the dict
+                _enter_container(path, stack, id(value._internal))
+                mapping: Dict[str, Any] = {}
+                children = []
+                for k, v in value.items():
+                    key = str(k._unroll(path))
+                    # insert now so the original key order is kept
+                    mapping[key] = None
+                    children.append((v, mapping, key))
+                parent[slot] = mapping
+                stack.extend(reversed(children))
+            elif kind == _YAML_TREE:
+                stack.append((value, parent, slot))
+            else:
+                raise ValueError("Invalid YAML tree structure")
+        return result[0]  # type: ignore
 
     @classmethod
     def wrap(cls, value: YamlValue, span: Span) -> "YamlTree":  # type: ignore
@@ -196,23 +380,58 @@ class YamlTree(Generic[T]):
         Wraps a value in a YamlTree and attaches the span everywhere.
         This exists so you can take generate a datastructure from user input, but track all the errors within that
         datastructure back to the user input
+
+        Like `unroll`, this uses an explicit stack instead of recursion, and rejects values that
+        contain themselves. Leaves fall through to the final branch.
         """
-        if isinstance(value, list):
-            return YamlTree(value=[YamlTree.wrap(x, span) for x in value], span=span)
-        elif isinstance(value, dict):
-            return YamlTree(
-                value=YamlMap(
-                    {
-                        YamlTree.wrap(k, span): YamlTree.wrap(v, span)
-                        for k, v in value.items()
-                    }
-                ),
-                span=span,
-            )
-        elif isinstance(value, YamlTree):
-            return value
-        else:
-            return YamlTree(value, span)
+        if value.__class__ is YamlTree:
+            # already wrapped, eg. values produced by `SpanPreservingRuamelConstructor`
+            return value  # type: ignore
+        result: List[Any] = [None]
+        stack: List[Tuple[Any, Any, Any]] = [(value, result, 0)]
+        path: Set[int] = set()
+        while stack:
+            raw, parent, slot = stack.pop()
+            if raw is _LEAVE:
+                path.discard(parent)
+                continue
+            raw_type = type(raw)
+            kind = _value_kinds.get(raw_type) or _value_kind(raw_type)
+            if kind == _LIST:
+                _enter_container(path, stack, id(raw))
+                items: List[Any] = [None] * len(raw)
+                parent[slot] = YamlTree(value=items, span=span)
+                for i in range(len(raw) - 1, -1, -1):
+                    stack.append((raw[i], items, i))
+            elif kind == _DICT:
+                _enter_container(path, stack, id(raw))
+                internal: Dict[YamlTree, Any] = {}
+                children = []
+                for k, v in raw.items():
+                    key = YamlTree.wrap(k, span)
+                    internal[key] = None
+                    children.append((v, internal, key))
+                parent[slot] = YamlTree(value=YamlMap(internal), span=span)
+                stack.extend(reversed(children))
+            elif kind == _YAML_TREE:
+                parent[slot] = raw
+            else:
+                parent[slot] = YamlTree(raw, span)
+        return result[0]  # type: ignore
+
+
+# Stack marker for `YamlTree.unroll`/`wrap`: popped once all of a container's children are done
+_LEAVE = object()
+
+
+def _enter_container(
+    path: Set[int], stack: List[Tuple[Any, Any, Any]], container_id: int
+) -> None:
+    if container_id in path:
+        raise ValueError("Invalid YAML tree structure: a value contains itself")
+    path.add(container_id)
+    # pushed before the children, so it's popped after all of them
+    stack.append((_LEAVE, container_id, None))
 
 
 class YamlMap:
@@ -222,25 +441,44 @@ class YamlMap:
     necessary spans
     """
 
+    __slots__ = ("_internal", "_by_key", "_indexed_len")
+
     def __init__(self, internal: Dict[YamlTree[str], YamlTree]):
         self._internal = internal
+        # Index by the raw key so lookups don't need to scan every item. ruamel
+        # populates mappings after they are constructed, so this is built lazily
+        self._by_key: Dict[str, Tuple[YamlTree[str], YamlTree]] = {}
+        self._indexed_len = 0
+
+    def _index(self) -> Dict[str, Tuple[YamlTree[str], YamlTree]]:
+        if self._indexed_len != len(self._internal):
+            self._by_key = {}
+            for k, v in self._internal.items():
+                if isinstance(k.value, str):
+                    self._by_key.setdefault(k.value, (k, v))
+            self._indexed_len = len(self._internal)
+        return self._by_key
 
     def __getitem__(self, key: str) -> YamlTree:
-        return next(v for k, v in self._internal.items() if k.value == key)
+        return self._index()[key][1]
 
     def __setitem__(self, key: YamlTree[str], value: YamlTree) -> None:
+        index = self._index()
         self._internal[key] = value
+        if isinstance(key.value, str):
+            index[key.value] = (key, value)
+        self._indexed_len = len(self._internal)
 
     def items(self) -> ItemsView[YamlTree[str], YamlTree]:
         return self._internal.items()
 
     def key_tree(self, key: str) -> YamlTree[str]:
-        return next(k for k, v in self._internal.items() if k.value == key)
+        return self._index()[key][0]
 
     def get(self, key: str) -> Optional[YamlTree]:
-        match = [v for k, v in self._internal.items() if k.value == key]
+        match = self._index().get(key)
         if match:
-            return match[0]
+            return match[1]
         return None
 
     def keys(self) -> KeysView[YamlTree[str]]:
@@ -250,7 +488,45 @@ class YamlMap:
 def parse_yaml(contents: str) -> Dict[str, Any]:
     # this uses the `RoundTripConstructor` which inherits from `SafeConstructor`
     yaml = YAML(typ="rt")
-    return yaml.load(StringIO(contents))  # type: ignore
+    return yaml.load(contents)  # type: ignore
+
+
+class SpanPreservingRuamelConstructor(SafeConstructor):
+    """
+    Constructor that wraps every constructed value in a YamlTree carrying its Span.
+    `_source_hash` and `_filename` are set on the instance before each load.
+
+    This builds on `SafeConstructor` rather than `RoundTripConstructor`: the spans are all we
+    need to keep, so there's no point paying for comment, anchor and style bookkeeping.
+    """
+
+    _source_hash: SourceFileHash
+    _filename: Optional[str] = None
+
+    def construct_object(self, node: Node, deep: bool = False) -> YamlTree:
+        r = super().construct_object(node, deep)
+        if isinstance(r, dict):
+            r = YamlMap(r)
+        return YamlTree(
+            r,
+            Span.from_node(
+                node, source_hash=self._source_hash, filename=self._filename
+            ),
+        )
+
+    def construct_mapping(self, node: Node, deep: bool = False) -> Dict[Any, Any]:
+        mapping = super().construct_mapping(node, deep)
+        if getattr(node, "merge", None) is None:
+            return mapping
+        # With merge keys (`<<: *anchor`) ruamel constructs the merged entries alongside the
+        # explicit ones, and every key is a distinct YamlTree, so nothing gets overwritten.
+        # Keep only the last entry for each key, which gives explicit keys precedence over
+        # merged ones (and earlier merged mappings over later ones), as in a plain dict
+        entries: Dict[Any, Tuple[YamlTree, YamlTree]] = {}
+        for k, v in mapping.items():
+            key = k.value if isinstance(k.value, (str, int)) else k
+            entries[key] = (k, v)
+        return dict(entries.values())
 
 
 def parse_yaml_preserve_spans(contents: str, filename: Optional[str]) -> YamlTree:
@@ -258,21 +534,17 @@ def parse_yaml_preserve_spans(contents: str, filename: Optional[str]) -> YamlTre
     parse yaml into a YamlTree object. The resulting spans are tracked in SourceTracker
     so they can be used later when constructing error messages or displaying context.
     """
-    # this uses the `RoundTripConstructor` which inherits from `SafeConstructor`
     source_hash = SourceTracker.add_source(contents)
 
-    class SpanPreservingRuamelConstructor(RoundTripConstructor):
-        def construct_object(self, node: Node, deep: bool = False) -> YamlTree:
-            r = super().construct_object(node, deep)
-            if isinstance(r, dict):
-                r = YamlMap(r)
-            return YamlTree(
-                r, Span.from_node(node, source_hash=source_hash, filename=filename)
-            )
-
-    yaml = YAML()
+    # A fresh YAML per parse: the loader keeps state such as the document's %YAML version
+    # and %TAG handles between loads, which would leak from one rule file into the next.
+    # pure=True since the C loader would build a new constructor for every load,
+    # bypassing `SpanPreservingRuamelConstructor`
+    yaml = YAML(typ="safe", pure=True)
     yaml.Constructor = SpanPreservingRuamelConstructor
-    data = yaml.load(StringIO(contents))
+    yaml.constructor._source_hash = source_hash
+    yaml.constructor._filename = filename
+    data = yaml.load(contents)
     if not isinstance(data, YamlTree):
         raise Exception(
             f"Something went wrong parsing Yaml (expected a YamlTree as output): {PLEASE_FILE_ISSUE_TEXT}"
@@ -280,4 +552,12 @@ def parse_yaml_preserve_spans(contents: str, filename: Optional[str]) -> YamlTre
     return data
 
 
-EmptySpan = parse_yaml_preserve_spans("a: b", None).span
+# Span for values that don't come from any source file, eg. rules loaded from json
+EmptySpan = Span(
+    start_line=0,
+    start_col=0,
+    end_line=0,
+    end_col=0,
+    source_hash=SourceFileHash(""),
+    file=None,
+)
@@ -1,11 +1,17 @@
 from pathlib import Path
+from typing import Any
+from typing import List
 
 import attr
+import pytest
+from ruamel.yaml.constructor import ConstructorError
 
+from semgrep.rule_lang import EmptySpan
 from semgrep.rule_lang import parse_yaml
 from semgrep.rule_lang import parse_yaml_preserve_spans
 from semgrep.rule_lang import Position
 from semgrep.rule_lang import Span
+from semgrep.rule_lang import YamlTree
 
 test_yaml = """---
 a:
@@ -23,7 +29,13 @@ def test_span_tracking():
     data = parse_yaml_preserve_spans(test_yaml, Path("filename"))
 
     def test_span(start: Position, end: Position) -> Span:
-        return attr.evolve(data.span, start=start, end=end)
+        return attr.evolve(
+            data.span,
+            start_line=start.line,
+            start_col=start.col,
+            end_line=end.line,
+            end_col=end.col,
+        )
 
     # basic spans
     assert data.span == test_span(
@@ -51,3 +63,121 @@ def test_span_tracking():
 
     # unrolling is equivalent
     assert data.unroll() == parse_yaml(test_yaml)
+
+
+def test_yaml_map_lookup():
+    data = parse_yaml_preserve_spans(test_yaml, Path("filename"))
+    rule = data.value["a"].value[3].value
+
+    assert rule["key"].value == "value"
+    assert rule.get("key").value == "value"
+    assert rule.get("missing") is None
+    assert rule.key_tree("key").span.start == Position(line=6, col=5)
+
+    new_value = YamlTree("other", rule["key"].span)
+    rule[rule.key_tree("key")] = new_value
+    assert rule["key"] is new_value
+    assert len(list(rule.items())) == 1
+
+
+def test_merge_keys():
+    data = parse_yaml_preserve_spans(
+        "base: &b {x: 1, z: 0}\nd: {<<: *b, y: 2}\ne: {<<: *b, x: 3}\n",
+        Path("filename"),
+    )
+
+    # merged keys appear once, and explicit keys take precedence over merged ones
+    assert [k.value for k in data.value["d"].value.keys()] == ["x", "z", "y"]
+    assert [k.value for k in data.value["e"].value.keys()] == ["x", "z"]
+    assert data.value["e"].value["x"].value == 3
+    assert data.value["e"].value.key_tree("x").span.start == Position(line=3, col=13)
+    assert data.unroll() == {
+        "base": {"x": 1, "z": 0},
+        "d": {"x": 1, "z": 0, "y": 2},
+        "e": {"x": 3, "z": 0},
+    }
+
+
+def test_recursive_aliases():
+    # an alias back to an enclosing node makes the tree contain itself
+    for contents in [
+        "a: &a [*a]\n",
+        "a: &a {b: *a}\n",
+        "rules: &r\n  - id: x\n    metadata: *r\n",
+    ]:
+        data = parse_yaml_preserve_spans(contents, Path("filename"))
+        with pytest.raises(ValueError):
+            data.unroll()
+
+    # reusing an alias that doesn't contain itself is fine
+    data = parse_yaml_preserve_spans("b: &b [1]\nc: [*b, *b]\n", Path("filename"))
+    assert data.unroll() == {"b": [1], "c": [[1], [1]]}
+
+    cycle: List[Any] = []
+    cycle.append(cycle)
+    with pytest.raises(ValueError):
+        YamlTree.wrap(cycle, EmptySpan)
+
+
+def test_unknown_tags():
+    # values with tags we don't know how to construct are rejected, naming the tag
+    for contents, tag in [
+        ("pattern: !foo bar\n", "!foo"),
+        ("a: !foo [1]\n", "!foo"),
+        ("a: !foo {x: 1}\n", "!foo"),
+        ("a: !!python/name:os.system ''\n", "tag:yaml.org,2002:python/name:os.system"),
+    ]:
+        with pytest.raises(ConstructorError, match=tag):
+            parse_yaml_preserve_spans(contents, Path("filename"))
+
+
+def test_span_with_context():
+    data = parse_yaml_preserve_spans(test_yaml, Path("filename"))
+    span = data.value["a"].value[1].span
+
+    # context is clamped to the start and end of the file
+    assert span.with_context(before=100, after=100).context_start == Position(
+        line=0, col=0
+    )
+    assert span.with_context(before=100, after=100).context_end == Position(
+        line=9, col=0
+    )
+
+    with_context = span.with_context(before=1, after=2)
+    assert with_context.context_start == Position(line=3, col=0)
+    assert with_context.context_end == Position(line=6, col=0)
+    assert with_context.start == span.start and with_context.end == span.end
+
+
+def test_span_with_context_cr_line_endings():
+    data = parse_yaml_preserve_spans("a: 1\rb: 2\r", Path("filename"))
+    span = data.value["b"].span
+
+    assert span.start.line == 2
+    assert span.with_context(after=100).context_end == Position(line=2, col=0)
+
+
+def test_span_to_json():
+    data = parse_yaml_preserve_spans(test_yaml, Path("filename"))
+    span = data.value["a"].value[1].span.with_context(before=1)
+
+    assert span.to_json() == {
+        "start": {"line": 4, "col": 5},
+        "end": {"line": 4, "col": 6},
+        "source_hash": span.source_hash,
+        "file": Path("filename"),
+        "context_start": {"line": 3, "col": 0},
+        "context_end": None,
+    }
+
+
+def test_yaml_version_does_not_leak_between_parses():
+    plain = "a: yes\nb: 0777\nc: y\n"
+    expected = {"a": "yes", "b": 777, "c": "y"}
+    assert parse_yaml_preserve_spans(plain, Path("filename")).unroll() == expected
+
+    yaml_1_1 = parse_yaml_preserve_spans("%YAML 1.1\n---\na: yes\n", Path("filename"))
+    assert yaml_1_1.unroll() == {"a": True}
+
+    # a %YAML directive only applies to its own document
+    assert parse_yaml_preserve_spans(plain, Path("filename")).unroll() == expected
@@ -1,4 +1,4 @@
-from typing import NamedTuple, Any
+from typing import NamedTuple, Any, Dict
 class LineCol(NamedTuple):
     line: int
     column: int
@@ -11,11 +11,19 @@ class RoundTripConstructor:
     def construct_object(self, node: Node, deep: bool = False) -> Any:
         ...
 
+class SafeConstructor:
+    def construct_object(self, node: Node, deep: bool = False) -> Any:
+        ...
+
+    def construct_mapping(self, node: Node, deep: bool = False) -> Dict[Any, Any]:
+        ...
+
 class YAML:
     Constructor: Any
+    constructor: Any
     representer: Any
 
-    def __init__(self, typ: str = 'rt'):
+    def __init__(self, typ: str = 'rt', pure: bool = False):
         ...
 
     def load(self, stream: Any) -> Any: